@@ -1,104 +1,495 @@
-from multiprocessing.spawn import prepare
-from xml.dom.minidom import Document
-import git
 import argparse
+import contextlib
+import fnmatch
+import functools
+import hashlib
+import json
+import logging
 import os
+import posixpath
+import shutil
+import subprocess
+import sys
+import tempfile
 
+CHUNK_SIZE = 64 * 1024
+DEFAULT_EXCLUDE = "src/Migration/Infrastructure/Persistence/Migrations/"
+EXCLUDE_MAGIC = ":(exclude)"
+NEWLINE = b"\n"
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "gitdiff")
+# Diff settings that pygit2_diff applies itself, or that do not change `git diff --no-color` output
+PYGIT2_DIFF_CONFIG = frozenset({
+    "diff.context", "diff.interhunkcontext", "diff.algorithm", "diff.indentheuristic", "diff.renames",
+    "diff.tool", "diff.guitool", "diff.colormoved", "diff.colormovedws", "diff.wserrorhighlight",
+    "diff.statgraphwidth", "diff.statnamewidth", "diff.dirstat", "diff.autorefreshindex",
+})
+# Environment variables with which git diff output differs from the repository configuration
+GIT_DIFF_ENVIRONMENT = ("GIT_EXTERNAL_DIFF", "GIT_DIFF_OPTS", "GIT_CONFIG_PARAMETERS", "GIT_CONFIG_COUNT")
 
-def get_git_diff(repo_path, output_file, exclude_patterns):
+log = logging.getLogger("gitdiff")
+
+
+def build_exclude_args(patterns):
+    """Turn exclude patterns into `git diff` pathspec arguments.
+
+    Repeated patterns are dropped, as git would otherwise match every path against each copy.
+    """
+    return tuple(f"{EXCLUDE_MAGIC}{pattern}" for pattern in dict.fromkeys(patterns))
+
+@functools.lru_cache(maxsize=None)
+def exclude_pattern(arg):
+    """Return the path pattern of an exclude pathspec, normalised the way git normalises it.
+
+    Returns None for patterns that is_excluded cannot match exactly like git, such as ones
+    pointing outside the repository or using further pathspec magic.
+    """
+    pattern = arg[len(EXCLUDE_MAGIC):]
+    if os.sep != "/":
+        pattern = pattern.replace(os.sep, "/")
+    elif "\\" in pattern:
+        # git reads a backslash as escaping the next character, fnmatch does not
+        return None
+    if not pattern or pattern.startswith((":", "/")):
+        return None
+    normalized = posixpath.normpath(pattern)
+    if normalized == ".." or normalized.startswith("../"):
+        return None
+    # A trailing slash limits the pattern to directories, so keep it
+    if pattern.endswith("/") and normalized != ".":
+        normalized += "/"
+    return normalized
+
+def is_excluded(path, exclude_args):
+    """Check a path against exclude pathspecs the way `git diff` matches them.
+
+    A pattern matches the path itself, anything below it when it names a directory, or the path
+    as a wildcard pattern (where `*` also matches `/`). Only patterns accepted by exclude_pattern
+    are matched.
+    """
+    for arg in exclude_args:
+        pattern = exclude_pattern(arg)
+        if pattern is None:
+            continue
+        if (pattern == "." or path == pattern or path.startswith(pattern.rstrip("/") + "/")
+                or fnmatch.fnmatchcase(path, pattern)):
+            return True
+    return False
+
+def pygit2_diff_options(pygit2, config):
+    """Turn the diff settings in a repository's configuration into arguments for Repository.diff.
+
+    Returns None when a setting changes the output in a way libgit2 cannot reproduce, such as the
+    histogram algorithm, textconv drivers or other path prefixes.
+    """
+    names = {entry.name.lower() for entry in config}
+    if "core.quotepath" in names or any(name.startswith("diff.") and name not in PYGIT2_DIFF_CONFIG
+                                        for name in names):
+        return None
+    if "diff.renames" in names and not config.get_bool("diff.renames"):
+        return None
+    algorithms = {"default": 0, "myers": 0, "minimal": pygit2.GIT_DIFF_MINIMAL,
+                  "patience": pygit2.GIT_DIFF_PATIENCE}
+    algorithm = config["diff.algorithm"].lower() if "diff.algorithm" in names else "default"
+    if algorithm not in algorithms:
+        return None
+    flags = pygit2.GIT_DIFF_NORMAL | algorithms[algorithm]
+    # git uses the indent heuristic unless it is turned off
+    if "diff.indentheuristic" not in names or config.get_bool("diff.indentheuristic"):
+        flags |= pygit2.GIT_DIFF_INDENT_HEURISTIC
+    options = {"flags": flags}
+    if "diff.context" in names:
+        options["context_lines"] = config.get_int("diff.context")
+    if "diff.interhunkcontext" in names:
+        options["interhunk_lines"] = config.get_int("diff.interhunkcontext")
+    return options
+
+def patch_text(patch):
+    """Return the text of a pygit2 patch the way `git diff` prints it."""
+    data = patch.data
+    if not patch.hunks and not patch.delta.is_binary:
+        # git leaves out the ---/+++ lines of files without content changes, such as new empty files
+        data = b"".join(line for line in data.splitlines(keepends=True)
+                        if not line.startswith((b"--- ", b"+++ ")))
+    return data
+
+def pygit2_diff(repo_path, target_branch, feature_branch, exclude_args):
+    """Diff two branches in-process with libgit2, without starting a git process.
+
+    Returns an iterator over the patch of each file, or None when pygit2 is not installed or the
+    diff cannot be reproduced in-process, so the caller can fall back to `git diff`.
+    """
     try:
-        # Open the repository
-        repo = git.Repo(repo_path)
-        
-        # Ensure the repo is not bare
-        if repo.bare:
-            print("Error: Repository is bare")
-            return
-        
-        # Prepare exclusion arguments
-        exclude_args = [f":(exclude){pattern}" for pattern in exclude_patterns]
-        
-        # Get the git diff (unstaged changes)
-        unstaged_diff = repo.git.diff("--", *exclude_args)
-        
-        # Get staged changes
-        staged_diff = repo.git.diff('--cached', *exclude_args)
-
-        output = f"Repository: {repo_path}\n\n==== Unstaged Changes ====\n"
-        output += unstaged_diff if unstaged_diff else "No unstaged changes."
-        output += "\n\n==== Staged Changes ====\n"
-        output += staged_diff if staged_diff else "No staged changes."
-        
-        print(output)
-        write_to_file(output_file, output)
-    except git.exc.InvalidGitRepositoryError:
-        print("Error: Not a valid git repository.")
+        import pygit2
+    except ImportError:
+        return None
+    if (any(exclude_pattern(arg) is None for arg in exclude_args)
+            or any(name in os.environ for name in GIT_DIFF_ENVIRONMENT)):
+        return None
+    try:
+        repo = pygit2.Repository(repo_path)
+        options = pygit2_diff_options(pygit2, repo.config)
+        if options is None:
+            return None
+        target = repo.revparse_single(target_branch).peel(pygit2.Commit)
+        feature = repo.revparse_single(feature_branch).peel(pygit2.Commit)
+        diff = repo.diff(target, feature, **options)
+        # git diff detects renames by default, so do the same
+        diff.find_similar()
+        # git applies the exclude pathspecs before rename detection, but libgit2 cannot drop deltas
+        # from a diff. A rename across the exclusion boundary would then pair a file git never sees,
+        # so leave those diffs to git.
+        for delta in diff.deltas:
+            if (is_excluded(delta.old_file.path, exclude_args)
+                    != is_excluded(delta.new_file.path, exclude_args)):
+                return None
+    except (pygit2.GitError, KeyError, ValueError) as e:
+        log.debug("pygit2 cannot produce the diff, using git: %s", e)
+        return None
+    return (patch_text(patch) for patch in diff
+            if not is_excluded(patch.delta.new_file.path, exclude_args))
+
+@functools.lru_cache(maxsize=None)
+def git_executable():
+    """Full path of the git executable, looked up once."""
+    return shutil.which("git") or "git"
+
+def git_command(repo_path, *args):
+    """Build the argument list for running git in repo_path.
+
+    git is started by its full path and with close_fds=False, as on POSIX subprocess only uses the
+    cheaper posix_spawn instead of fork+exec under those conditions. Keeping descriptors open is
+    safe because Python opens files as non-inheritable, so nothing leaks into git.
+    """
+    return [git_executable(), "-C", repo_path, *args]
+
+def changed_sides(repo_path, exclude_args):
+    """Check which of the unstaged and staged diffs would have any changes in them.
+
+    Runs a single `git status`, which only needs the index stat cache and so is far cheaper than a
+    `git diff` on a clean or nearly clean tree. Returns (has_unstaged, has_staged).
+    """
+    cmd = git_command(repo_path, "status", "--porcelain=v2", "-z", "--untracked-files=no", "--", *exclude_args)
+    status = subprocess.run(cmd, stdout=subprocess.PIPE, check=True, close_fds=False).stdout
+    entries = iter(status.split(b"\0"))
+    has_unstaged = has_staged = False
+    for entry in entries:
+        kind = entry[:2]
+        if kind == b"u ":
+            # Unmerged paths show up in both diffs
+            return True, True
+        if kind in (b"1 ", b"2 "):
+            # The XY field holds the staged and unstaged state, "." meaning unchanged
+            has_staged = has_staged or entry[2:3] != b"."
+            has_unstaged = has_unstaged or entry[3:4] != b"."
+            if kind == b"2 ":
+                # Renames are followed by the original path as a separate entry
+                next(entries, None)
+    return has_unstaged, has_staged
+
+def open_git_diff(repo_path, *diff_args, stdout=subprocess.PIPE):
+    """Start `git diff` and return the process, with its output on an unbuffered pipe by default."""
+    cmd = git_command(repo_path, "diff", "--no-color", *diff_args)
+    return subprocess.Popen(cmd, stdout=stdout, bufsize=0, close_fds=False)
+
+def wait_git(proc):
+    """Wait for a git process to finish and raise if it failed."""
+    returncode = proc.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, proc.args)
+
+def diff_into_file(out, repo_path, *diff_args):
+    """Have git write a diff straight into out. Returns True if it wrote anything."""
+    out.flush()
+    start = out.seek(0, os.SEEK_END)
+    with open_git_diff(repo_path, *diff_args, stdout=out) as proc:
+        wait_git(proc)
+    # git wrote through the shared file descriptor, so move our position past its output
+    return out.seek(0, os.SEEK_END) > start
+
+def append_file(src, out):
+    """Append the contents of src to out, inside the kernel on Linux. Returns True if src was not empty."""
+    out.flush()
+    size = os.fstat(src.fileno()).st_size
+    if sys.platform.startswith("linux"):
+        offset = 0
+        while offset < size:
+            offset += os.sendfile(out.fileno(), src.fileno(), offset, size - offset)
+        out.seek(0, os.SEEK_END)
+    else:
+        src.seek(0)
+        shutil.copyfileobj(src, out)
+    return size > 0
+
+def is_compressed(filename):
+    return filename.endswith(".zst")
+
+def open_output(filename):
+    """Open the output file for writing bytes. Names ending in .zst are compressed with zstd.
+
+    Diffs compress to a small fraction of their size, so on all but the fastest disks compressing
+    on every core is quicker than writing the raw diff.
+    """
+    if not is_compressed(filename):
+        return open(filename, "wb")
+    import zstandard
+    return zstandard.ZstdCompressor(level=3, threads=-1).stream_writer(open(filename, "wb"))
+
+def head_lines(data, count):
+    """Return the first count lines of data, keeping their line endings."""
+    end = 0
+    for _ in range(count):
+        end = data.find(NEWLINE, end) + 1
+        if not end:
+            return data
+    return data[:end]
+
+def truncation_marker(dropped):
+    return f"...<truncated {dropped} more lines>\n".encode("utf-8")
+
+def copy_chunks(chunks, out, echo=False, max_lines=None):
+    """Copy diff chunks into out as they arrive, stopping after max_lines lines.
+
+    Returns the number of lines in chunks, including any that were cut off.
+    """
+    if echo:
+        sys.stdout.flush()
+    lines = 0
+    for chunk in chunks:
+        chunk_lines = chunk.count(NEWLINE)
+        if max_lines is not None and lines + chunk_lines >= max_lines:
+            # Keep consuming so the dropped lines are counted (and git can exit)
+            chunk = head_lines(chunk, max(max_lines - lines, 0))
+        if chunk:
+            out.write(chunk)
+            # Flush each chunk so whatever reads the file or console sees patches as they are made.
+            # A compressed stream can't be read before it is finished, and flushing it would end a
+            # zstd block (and wait for the compression threads) every time, so leave it be.
+            if out.seekable():
+                out.flush()
+            if echo:
+                sys.stdout.buffer.write(chunk)
+                sys.stdout.buffer.flush()
+        lines += chunk_lines
+    if max_lines is not None and lines > max_lines:
+        emit(out, truncation_marker(lines - max_lines), echo)
+    return lines
+
+def copy_diff(proc, out, echo=False, max_lines=None):
+    """Copy a running `git diff` into out, see copy_chunks. Raises if git fails."""
+    lines = copy_chunks(iter(lambda: proc.stdout.read(CHUNK_SIZE), b""), out, echo, max_lines)
+    wait_git(proc)
+    return lines
+
+def write_local_diffs(out, repo_path, exclude_args, has_unstaged, has_staged, echo=False, max_lines=None):
+    """Write the unstaged and staged changes to out and return the line count of each."""
+    # Start both diffs up front so the staged diff runs while the unstaged one is copied.
+    # Each diff is streamed straight into the file, so it is never held in memory whole.
+    with contextlib.ExitStack() as stack:
+        unstaged = (stack.enter_context(open_git_diff(repo_path, "--", *exclude_args))
+                    if has_unstaged else None)
+        staged = (stack.enter_context(open_git_diff(repo_path, "--cached", "--", *exclude_args))
+                  if has_staged else None)
+        emit(out, f"Repository: {repo_path}\n\n==== Unstaged Changes ====\n".encode("utf-8"), echo)
+        unstaged_lines = copy_diff(unstaged, out, echo, max_lines) if unstaged else 0
+        if not unstaged_lines:
+            emit(out, b"No unstaged changes.", echo)
+        emit(out, b"\n\n==== Staged Changes ====\n", echo)
+        staged_lines = copy_diff(staged, out, echo, max_lines) if staged else 0
+        if not staged_lines:
+            emit(out, b"No staged changes.", echo)
+    return unstaged_lines, staged_lines
+
+def write_local_diffs_direct(out, repo_path, exclude_args, has_unstaged, has_staged):
+    """Write the local changes like get_git_diff, but let git write the diffs into the files itself.
+
+    The staged diff runs at the same time into a temporary file, which is appended afterwards, so
+    the diff data never passes through Python.
+    """
+    with contextlib.ExitStack() as stack:
+        if has_staged:
+            staged_file = stack.enter_context(tempfile.TemporaryFile())
+            staged = stack.enter_context(
+                open_git_diff(repo_path, "--cached", "--", *exclude_args, stdout=staged_file))
+        out.write(f"Repository: {repo_path}\n\n==== Unstaged Changes ====\n".encode("utf-8"))
+        if not (has_unstaged and diff_into_file(out, repo_path, "--", *exclude_args)):
+            out.write(b"No unstaged changes.")
+        out.write(b"\n\n==== Staged Changes ====\n")
+        if has_staged:
+            wait_git(staged)
+        if not (has_staged and append_file(staged_file, out)):
+            out.write(b"No staged changes.")
+
+def open_repo(repo_path):
+    """Open the repository containing repo_path, once for the whole run.
+
+    Returns None after printing the reason when there is no usable repository.
+    """
+    # Imported here rather than at the top so that --help does not pay for loading GitPython
+    import git
+    try:
+        # GitCmdObjectDB reads objects through a persistent git process, which is faster than the
+        # pure Python default for any object lookups.
+        repo = git.Repo(repo_path, search_parent_directories=True, odbt=git.GitCmdObjectDB)
+    except (git.exc.InvalidGitRepositoryError, git.exc.NoSuchPathError):
+        log.error("Error: Not a valid git repository: %s", repo_path)
+        return None
+
+    # Ensure the repo is not bare
+    if repo.bare:
+        log.error("Error: Repository is bare")
+        return None
+    return repo
+
+def get_git_diff(repo, output_file, exclude_args, print_diff=False, quiet=False, max_lines=None):
+    """Show the unstaged and staged changes in the repository opened by open_repo."""
+    repo_path = repo.working_tree_dir
+    try:
+        # Only run the diffs that git status says have changes in them
+        has_unstaged, has_staged = changed_sides(repo_path, exclude_args)
+
+        with open_output(output_file) as f:
+            # When nothing needs to look at the diffs, git can write them into the file itself.
+            # That needs a file it can seek in, so pipes such as /dev/stdout are copied instead.
+            if quiet and not print_diff and max_lines is None and f.seekable():
+                write_local_diffs_direct(f, repo_path, exclude_args, has_unstaged, has_staged)
+            else:
+                unstaged_lines, staged_lines = write_local_diffs(
+                    f, repo_path, exclude_args, has_unstaged, has_staged, print_diff, max_lines)
+                if not quiet:
+                    log.info("Unstaged: %d lines, Staged: %d lines", unstaged_lines, staged_lines)
+        if print_diff:
+            print()
+        log.info("Diff result saved to file: %s", output_file)
     except Exception as e:
-        print(f"Error: {e}")
+        log.error("Error: %s", e)
 
-def get_branch_diff(repo_path, feature_branch, target_branch, output_file, exclude_patterns):
-    """Compare two branches and show the diff between them."""
+def ref_cache_key(git_dir):
+    """Describe the state of the refs by the size and modification time of the files holding them."""
+    parts = []
+    for name in ("packed-refs", os.path.join("refs", "heads"), os.path.join("refs", "remotes", "origin")):
+        try:
+            stat = os.stat(os.path.join(git_dir, name))
+            parts.append(f"{stat.st_mtime_ns}-{stat.st_size}")
+        except FileNotFoundError:
+            parts.append("-")
+    return ":".join(parts)
+
+def load_ref_names(repo, refresh=False):
+    """Return the names of the local branches and of all refs as two sets.
+
+    Scanning the refs is slow on repositories with many of them, so the names are cached on disk
+    and reused for as long as the ref files are unchanged. refresh skips the cache.
+    """
+    git_dir = os.path.abspath(repo.common_dir)
+    key = ref_cache_key(git_dir)
+    cache_file = os.path.join(CACHE_DIR, f"refs-{hashlib.sha1(git_dir.encode('utf-8')).hexdigest()}.json")
+    if not refresh:
+        try:
+            with open(cache_file, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+            if cached["key"] == key:
+                return set(cached["heads"]), set(cached["refs"])
+        except (OSError, ValueError, KeyError):
+            pass
+
+    heads = {head.name for head in repo.heads}
+    refs = {ref.name for ref in repo.refs}
     try:
-        repo = git.Repo(repo_path)
-        if repo.bare:
-            print("Error: Repository is bare")
-            return
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(cache_file, "w", encoding="utf-8") as f:
+            json.dump({"key": key, "heads": sorted(heads), "refs": sorted(refs)}, f)
+    except OSError:
+        pass
+    return heads, refs
 
+def get_branch_diff(repo, feature_branch, target_branch, output_file, exclude_args,
+                    print_diff=False, quiet=False, max_lines=None, summary=None):
+    """Compare two branches and show the diff between them."""
+    repo_path = repo.working_tree_dir
+    try:
         # Get current branch if feature_branch is None
         if feature_branch is None:
             feature_branch = repo.active_branch.name
-            print(f"No feature branch specified. Using current branch: {feature_branch}")
+            log.info("No feature branch specified. Using current branch: %s", feature_branch)
+
+        # Read the branch names once into sets, from the on-disk cache when it is still valid.
+        heads, refs = load_ref_names(repo)
+        if not all(branch in heads or f"origin/{branch}" in refs for branch in (target_branch, feature_branch)):
+            # Nested branch names do not always change the cache key, so check again before giving up
+            heads, refs = load_ref_names(repo, refresh=True)
 
         # Check if the target branch exists locally. If not, try checking remote.
-        if target_branch not in repo.heads:
-            print(f"Error: Target branch '{target_branch}' does not exist locally.")
+        if target_branch not in heads:
+            log.info("Target branch '%s' does not exist locally.", target_branch)
             remote_target = f"origin/{target_branch}"
-            if remote_target in repo.refs:
-                print(f"Target branch '{target_branch}' not found locally. Using remote branch '{remote_target}'.")
+            if remote_target in refs:
+                log.info("Target branch '%s' not found locally. Using remote branch '%s'.", target_branch, remote_target)
                 target_branch = remote_target
             else:
                 msg = f"Error: Target branch '{target_branch}' does not exist locally or remotely."
-                print(msg)
-                write_to_file(output_file, msg)
+                log.error("%s", msg)
+                write_to_file(output_file, msg.encode("utf-8"))
                 return
             
          # Check if the feature branch exists locally. If not, try checking remote.
-        if feature_branch not in repo.heads:
+        if feature_branch not in heads:
             # Check if the remote has the branch (assuming origin)
             remote_feature = f"origin/{feature_branch}"
-            if remote_feature in repo.refs:
-                print(f"Feature branch '{feature_branch}' not found locally. Using remote branch '{remote_feature}'.")
+            if remote_feature in refs:
+                log.info("Feature branch '%s' not found locally. Using remote branch '%s'.", feature_branch, remote_feature)
                 feature_branch = remote_feature
             else:
                 msg = f"Error: Feature branch '{feature_branch}' does not exist locally or remotely."
-                print(msg)
-                write_to_file(output_file, msg)
+                log.error("%s", msg)
+                write_to_file(output_file, msg.encode("utf-8"))
                 return
 
-        # Build exclusion arguments.
-        exclude_args = [f":(exclude){pattern}" for pattern in exclude_patterns] if exclude_patterns else []
-
-
         # Get the diff. This shows changes in the feature branch relative to the target branch.
-        diff = repo.git.diff(target_branch, feature_branch, "--", *exclude_args)
-        output = (f"Diff between target branch '{target_branch}' and feature branch "
-                  f"'{feature_branch}':\n{diff if diff else 'No differences found between the branches.'}")
-        print(output)
-        write_to_file(output_file, output)
+        # It is written out file by file as it is produced rather than collected first.
+        with open_output(output_file) as f:
+            emit(f, (f"Diff between target branch '{target_branch}' and feature branch "
+                     f"'{feature_branch}':\n").encode("utf-8"), print_diff)
+            # Full diffs are produced in-process by pygit2 when it is installed.
+            patches = None if summary else pygit2_diff(repo_path, target_branch, feature_branch, exclude_args)
+            if patches is not None:
+                diff_lines = copy_chunks(patches, f, print_diff, max_lines)
+            else:
+                # A summary skips producing the hunks, which is much cheaper on large comparisons.
+                summary_args = [f"--{summary}"] if summary else []
+                with open_git_diff(repo_path, target_branch, feature_branch, *summary_args,
+                                   "--", *exclude_args) as proc:
+                    diff_lines = copy_diff(proc, f, print_diff, max_lines)
+            if not diff_lines:
+                emit(f, b"No differences found between the branches.", print_diff)
+        if print_diff:
+            print()
+        if not quiet:
+            log.info("Branch diff: %d lines", diff_lines)
+        log.info("Diff result saved to file: %s", output_file)
     
-    except git.exc.InvalidGitRepositoryError:
-        print(f"Error: {repo_path} is not a valid git repository.")
     except Exception as e:
-        print(f"Error: {e}")
+        log.error("Error: %s", e)
     
+def emit(out, content, echo=False):
+    """Write content to out, and to the console as well when echo is set."""
+    out.write(content)
+    if echo:
+        print_bytes(content)
+
+def print_bytes(content):
+    """Print raw bytes to the console without decoding them."""
+    sys.stdout.flush()
+    sys.stdout.buffer.write(content)
+    sys.stdout.buffer.flush()
+
 def write_to_file(filename, content):
-    """Write content to file and notify the user."""
+    """Write a short message, such as a missing branch error, to the output file and notify the user."""
     try:
-        with open(filename, "w", encoding="utf-8") as f:
+        with open_output(filename) as f:
             f.write(content)
-        print(f"\nDiff result saved to file: {filename}")
+        log.info("Diff result saved to file: %s", filename)
     except Exception as e:
-        print(f"Error writing to file {filename}: {e}")
+        log.error("Error writing to file %s: %s", filename, e)
 
 # def review_code_with_openai(diff):
 #     """Send the Git diff to OpenAI for a code review."""
@@ -116,6 +507,13 @@ def write_to_file(filename, content):
 
 #     return response["choices"][0]["message"]["content"]
 
+def non_negative_int(value):
+    """Parse a command line count, which cannot be negative."""
+    count = int(value)
+    if count < 0:
+        raise argparse.ArgumentTypeError(f"must not be negative: {value}")
+    return count
+
 def prepare_args():
     parser = argparse.ArgumentParser(
         description="Get git diffs. By default, shows local changes; use '--compare' to compare branches."
@@ -131,10 +529,21 @@ def prepare_args():
     parser.add_argument("-o", "--output", type=str,
                         help="File name to output the diff result (default: gitbranch.diff)")
     # Option to exclude files by pattern. Multiple --exclude can be provided.
-    parser.add_argument("-e", "--exclude", action="append", default=["src/Migration/Infrastructure/Persistence/Migrations/"],
+    parser.add_argument("-e", "--exclude", action="append", default=None,
                         help="File or directory pattern to exclude (can be used multiple times)")
 
+    # Console output. By default only a line count summary is logged, the full diff goes to the file.
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only print warnings and errors. Local changes are then "
+                        "written by git straight into the output file, unless it is a pipe or compressed")
+    parser.add_argument("--print-diff", action="store_true", help="Print the full diff to the console as well")
+    parser.add_argument("--max-lines", type=non_negative_int, default=None,
+                        help="Cut each diff off after this many lines (default: no limit)")
+    parser.add_argument("-S", "--summary", choices=["stat", "name-only", "name-status"], default=None,
+                        help="When comparing branches, output only a summary of the changed files instead of the full diff")
+
     args = parser.parse_args()
+    # The default exclusion is always applied, --exclude adds to it
+    args.exclude = (DEFAULT_EXCLUDE, *(args.exclude or ()))
     return args
 
 # def main():
@@ -148,16 +557,20 @@ def prepare_args():
 
 if __name__ == "__main__":
     args = prepare_args()
+    # Messages go to stderr, leaving stdout for the diff itself (--print-diff). --quiet keeps only problems.
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format="%(message)s")
     
      # Determine the output file path: default is inside repo_path with filename "gitdiff"
     output_file = args.output if args.output else os.path.join(args.repo_path, "gitbranch.diff")
+    exclude_args = build_exclude_args(args.exclude)
     
-    if args.compare:
+    if args.compare and not args.target_branch:
         # For branch comparison, target_branch must be provided.
-        if not args.target_branch:
-            print("For branch comparison, please provide a target branch using -t or --target_branch")
-        else:
-            get_branch_diff(args.repo_path, args.feature_branch, args.target_branch, output_file, args.exclude)
-
+        log.error("For branch comparison, please provide a target branch using -t or --target_branch")
     else:
-        get_git_diff(args.repo_path, output_file, args.exclude)
\ No newline at end of file
+        repo = open_repo(args.repo_path)
+        if repo is not None and args.compare:
+            get_branch_diff(repo, args.feature_branch, args.target_branch, output_file, exclude_args,
+                            args.print_diff, args.quiet, args.max_lines, args.summary)
+        elif repo is not None:
+            get_git_diff(repo, output_file, exclude_args, args.print_diff, args.quiet, args.max_lines)
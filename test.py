@@ -1,13 +1,100 @@
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, mock_open
+from collections import namedtuple
 import os
 import sys
 import tempfile
 import io
+import subprocess
 import git
 
 import get_git_diff as ggd
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
+
+def named_refs(*names):
+    """Build stand-ins for GitPython refs, which are looked up by name"""
+    refs = []
+    for name in names:
+        ref = MagicMock()
+        ref.name = name
+        refs.append(ref)
+    return refs
+
+def fake_git_process(output=b"", returncode=0):
+    """Build a stand-in for a `git diff` Popen process"""
+    proc = MagicMock()
+    proc.__enter__.return_value = proc
+    proc.stdout = io.BytesIO(output)
+    proc.wait.return_value = returncode
+    return proc
+
+# `git status --porcelain=v2 -z` output with both staged and unstaged changes
+STATUS_BOTH = b"1 MM N... 100644 100644 100644 abc123 def456 file.txt\0"
+# ... with a staged rename and addition only
+STATUS_STAGED = (b"2 R. N... 100644 100644 100644 abc123 abc123 R100 new.txt\0old.txt\0"
+                 b"1 A. N... 000000 100644 100644 000000 abc123 added.txt\0")
+
+LocalDiffCase = namedtuple("LocalDiffCase", "name status unstaged staged kwargs content printed logged not_logged diff_args")
+EXCLUDE_ARGS = (":(exclude)node_modules",)
+LOCAL_DIFF_CASES = [
+    LocalDiffCase(
+        name="summary",
+        status=STATUS_BOTH, unstaged=b"Sample unstaged diff\n", staged=b"Sample staged diff\nline 2\n", kwargs={},
+        content=(b"Repository: /mock/repo/path\n\n==== Unstaged Changes ====\nSample unstaged diff\n"
+                 b"\n\n==== Staged Changes ====\nSample staged diff\nline 2\n"),
+        printed=[],
+        logged=["Unstaged: 1 lines, Staged: 2 lines", "Diff result saved to file"],
+        not_logged=["Sample unstaged diff"],
+        diff_args=[["--", *EXCLUDE_ARGS], ["--cached", "--", *EXCLUDE_ARGS]]),
+    LocalDiffCase(
+        name="print_diff",
+        status=STATUS_BOTH, unstaged=b"Sample unstaged diff\n", staged=b"Sample staged diff\n",
+        kwargs={"print_diff": True},
+        content=(b"Repository: /mock/repo/path\n\n==== Unstaged Changes ====\nSample unstaged diff\n"
+                 b"\n\n==== Staged Changes ====\nSample staged diff\n"),
+        printed=["==== Unstaged Changes ====\nSample unstaged diff\n", "Sample staged diff\n\n"],
+        logged=["Unstaged: 1 lines, Staged: 1 lines", "Diff result saved to file"],
+        not_logged=["Sample unstaged diff"],
+        diff_args=[["--", *EXCLUDE_ARGS], ["--cached", "--", *EXCLUDE_ARGS]]),
+    LocalDiffCase(
+        name="no_changes",
+        status=b"", unstaged=None, staged=None, kwargs={},
+        content=(b"Repository: /mock/repo/path\n\n==== Unstaged Changes ====\nNo unstaged changes."
+                 b"\n\n==== Staged Changes ====\nNo staged changes."),
+        printed=[],
+        logged=["Unstaged: 0 lines, Staged: 0 lines"],
+        not_logged=[],
+        diff_args=[]),
+    LocalDiffCase(
+        name="only_staged_changes",
+        status=STATUS_STAGED, unstaged=None, staged=b"Sample staged diff\n", kwargs={},
+        content=(b"Repository: /mock/repo/path\n\n==== Unstaged Changes ====\nNo unstaged changes."
+                 b"\n\n==== Staged Changes ====\nSample staged diff\n"),
+        printed=[],
+        logged=["Unstaged: 0 lines, Staged: 1 lines"],
+        not_logged=[],
+        diff_args=[["--cached", "--", *EXCLUDE_ARGS]]),
+    LocalDiffCase(
+        name="max_lines",
+        status=STATUS_BOTH, unstaged=b"unstaged 1\nunstaged 2\nunstaged 3\n", staged=b"staged 1\n",
+        kwargs={"max_lines": 2},
+        content=(b"Repository: /mock/repo/path\n\n==== Unstaged Changes ====\nunstaged 1\nunstaged 2\n"
+                 b"...<truncated 1 more lines>\n\n\n==== Staged Changes ====\nstaged 1\n"),
+        printed=[],
+        logged=["Unstaged: 3 lines, Staged: 1 lines"],
+        not_logged=[],
+        diff_args=[["--", *EXCLUDE_ARGS], ["--cached", "--", *EXCLUDE_ARGS]]),
+]
+
 class TestGitDiffUtility(unittest.TestCase):
     
     def setUp(self):
@@ -28,165 +115,337 @@ class TestGitDiffUtility(unittest.TestCase):
         
         # Set repo.bare to False
         self.repo_instance.bare = False
+        self.repo_instance.working_tree_dir = "/mock/repo/path"
+        self.repo_instance.common_dir = os.path.join(self.temp_dir.name, ".git")
+        
+        # Keep the ref name cache inside the temporary directory
+        self.cache_dir_patcher = patch('get_git_diff.CACHE_DIR', os.path.join(self.temp_dir.name, "cache"))
+        self.cache_dir_patcher.start()
+        
+        # Mock subprocess.run, which runs `git status`. By default both sides have changes.
+        self.mock_run_patcher = patch('get_git_diff.subprocess.run')
+        self.mock_run = self.mock_run_patcher.start()
+        self.mock_run.return_value.stdout = STATUS_BOTH
+        
+        # Mock subprocess.Popen, which streams `git diff` output
+        self.mock_popen_patcher = patch('get_git_diff.subprocess.Popen')
+        self.mock_popen = self.mock_popen_patcher.start()
+        self.mock_popen.side_effect = lambda cmd, **kwargs: fake_git_process()
+        
+        # Use `git diff` for branch comparisons even where pygit2 is installed
+        self.mock_pygit2_patcher = patch('get_git_diff.pygit2_diff', return_value=None)
+        self.mock_pygit2 = self.mock_pygit2_patcher.start()
         
     def tearDown(self):
         # Clean up the temporary directory
         self.temp_dir.cleanup()
         self.mock_repo_patcher.stop()
+        self.mock_run_patcher.stop()
+        self.mock_popen_patcher.stop()
+        self.mock_pygit2_patcher.stop()
+        self.cache_dir_patcher.stop()
     
-    def test_get_git_diff_success(self):
-        """Test successful git diff for local changes"""
-        # Mock the git diff responses
-        self.repo_instance.git.diff.side_effect = [
-            "Sample unstaged diff",  # First call for unstaged changes
-            "Sample staged diff"     # Second call for staged changes
-        ]
-        
-        # Redirect stdout to capture print statements
-        captured_output = io.StringIO()
-        sys.stdout = captured_output
-        
-        # Call the function
-        ggd.get_git_diff("/mock/repo/path", self.temp_output, ["node_modules"])
+    def git_diff_args(self):
+        """Return the arguments after `git -C <path> diff --no-color` for each git call"""
+        return [call.args[0][5:] for call in self.mock_popen.call_args_list]
+    
+    def git_diff_output(self, output):
+        """Make every `git diff` call print output"""
+        self.mock_popen.side_effect = lambda cmd, **kwargs: fake_git_process(output)
+    
+    def read_output(self):
+        with open(self.temp_output, 'rb') as f:
+            return f.read()
+    
+    def test_get_git_diff(self):
+        """Test showing local changes, one case per row of LOCAL_DIFF_CASES"""
+        for case in LOCAL_DIFF_CASES:
+            with self.subTest(case=case.name), \
+                    patch('get_git_diff.open', mock_open(), create=True) as mock_file:
+                self.mock_run.reset_mock()
+                self.mock_run.return_value.stdout = case.status
+                self.mock_popen.reset_mock()
+                self.mock_popen.side_effect = lambda cmd, **kwargs: fake_git_process(
+                    case.staged if "--cached" in cmd else case.unstaged
+                )
+                
+                # Redirect stdout to capture the diff, which is echoed as bytes. Messages are logged.
+                captured_output = io.TextIOWrapper(io.BytesIO())
+                sys.stdout = captured_output
+                try:
+                    with self.assertLogs("gitdiff", level="INFO") as logs:
+                        ggd.get_git_diff(self.repo_instance, self.temp_output, EXCLUDE_ARGS, **case.kwargs)
+                finally:
+                    captured_output.flush()
+                    sys.stdout = sys.__stdout__
+                printed = captured_output.buffer.getvalue().decode("utf-8")
+                logged = "\n".join(logs.output)
+                
+                # git status is asked once, with the same exclusions as the diffs
+                self.mock_run.assert_called_once_with(
+                    [ggd.git_executable(), "-C", "/mock/repo/path", "status", "--porcelain=v2", "-z",
+                     "--untracked-files=no", "--", *EXCLUDE_ARGS],
+                    stdout=subprocess.PIPE, check=True, close_fds=False)
+                
+                # Only the diffs with changes are run, each streaming from a pipe
+                self.assertEqual(self.git_diff_args(), case.diff_args)
+                for call in self.mock_popen.call_args_list:
+                    self.assertEqual(call.args[0][:5], [ggd.git_executable(), "-C", "/mock/repo/path", "diff", "--no-color"])
+                    self.assertEqual(call.kwargs, {"stdout": subprocess.PIPE, "bufsize": 0, "close_fds": False})
+                
+                # Check what was written and printed
+                mock_file.assert_called_once_with(self.temp_output, "wb")
+                written = b"".join(call.args[0] for call in mock_file().write.call_args_list)
+                self.assertEqual(written, case.content)
+                for text in case.printed:
+                    self.assertIn(text, printed)
+                for text in case.logged:
+                    self.assertIn(text, logged)
+                for text in case.not_logged:
+                    self.assertNotIn(text, logged)
+                if "print_diff" not in case.kwargs:
+                    self.assertEqual(printed, "")
+    
+    def test_get_git_diff_quiet_writes_directly(self):
+        """Test that git writes the diffs into the file itself when nothing is printed"""
+        def fake_git_writing_to_file(cmd, stdout, **kwargs):
+            os.write(stdout.fileno(), b"Sample staged diff\n" if "--cached" in cmd else b"Sample unstaged diff\n")
+            return fake_git_process()
+        self.mock_popen.side_effect = fake_git_writing_to_file
         
-        # Reset stdout
-        sys.stdout = sys.__stdout__
+        ggd.get_git_diff(self.repo_instance, self.temp_output, [], quiet=True)
         
-        # Check that the mock was called correctly
-        self.repo_instance.git.diff.assert_any_call("--", ":(exclude)node_modules")
-        self.repo_instance.git.diff.assert_any_call("--cached", ":(exclude)node_modules")
+        # Neither diff was piped through Python
+        for call in self.mock_popen.call_args_list:
+            self.assertNotEqual(call.kwargs["stdout"], subprocess.PIPE)
         
-        # Verify the output file was created with correct content
         with open(self.temp_output, 'r') as f:
-            content = f.read()
-            self.assertIn("Repository: /mock/repo/path", content)
-            self.assertIn("Sample unstaged diff", content)
-            self.assertIn("Sample staged diff", content)
-            
-        # Check print output
-        self.assertIn("Diff result saved to file", captured_output.getvalue())
+            self.assertEqual(f.read(),
+                             "Repository: /mock/repo/path\n\n==== Unstaged Changes ====\nSample unstaged diff\n"
+                             "\n\n==== Staged Changes ====\nSample staged diff\n")
+    
+    @unittest.skipUnless(os.path.isdir("/dev/fd"), "needs /dev/fd")
+    def test_get_git_diff_quiet_to_pipe(self):
+        """Test that output git cannot seek in, such as a pipe, is still copied through Python"""
+        self.git_diff_output(b"Sample diff\n")
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        try:
+            ggd.get_git_diff(self.repo_instance, f"/dev/fd/{write_fd}", [], quiet=True)
+        finally:
+            os.close(write_fd)
+
+        for call in self.mock_popen.call_args_list:
+            self.assertEqual(call.kwargs["stdout"], subprocess.PIPE)
+        with os.fdopen(os.dup(read_fd), "rb") as f:
+            self.assertEqual(f.read(),
+                             b"Repository: /mock/repo/path\n\n==== Unstaged Changes ====\nSample diff\n"
+                             b"\n\n==== Staged Changes ====\nSample diff\n")
+
+    @unittest.skipUnless(zstandard, "zstandard is not installed")
+    def test_get_git_diff_zstd_output(self):
+        """Test that an output file ending in .zst is compressed"""
+        self.mock_popen.side_effect = lambda cmd, **kwargs: fake_git_process(
+            b"Sample staged diff\n" if "--cached" in cmd else b"Sample unstaged diff\n"
+        )
+        compressed_output = self.temp_output + ".zst"
+        
+        ggd.get_git_diff(self.repo_instance, compressed_output, [], quiet=True)
+        
+        with open(compressed_output, 'rb') as f:
+            content = zstandard.ZstdDecompressor().stream_reader(f).read()
+        self.assertIn(b"Sample unstaged diff\n", content)
+        self.assertIn(b"Sample staged diff\n", content)
     
-    def test_get_git_diff_no_changes(self):
-        """Test git diff with no changes"""
-        # Mock the git diff responses with empty strings (no changes)
-        self.repo_instance.git.diff.side_effect = ["", ""]
+    def test_get_git_diff_git_failure(self):
+        """Test handling a git diff that exits with an error"""
+        self.mock_popen.side_effect = lambda cmd, **kwargs: fake_git_process(returncode=128)
         
-        ggd.get_git_diff("/mock/repo/path", self.temp_output, [])
+        with self.assertLogs("gitdiff", level="ERROR") as logs:
+            ggd.get_git_diff(self.repo_instance, self.temp_output, [])
         
-        # Verify the output file has correct content for no changes
-        with open(self.temp_output, 'r') as f:
-            content = f.read()
-            self.assertIn("No unstaged changes", content)
-            self.assertIn("No staged changes", content)
+        # Check error message
+        self.assertIn("returned non-zero exit status 128", logs.output[0])
+    
+    def test_open_repo(self):
+        """Test opening the repository once for the run"""
+        self.assertIs(ggd.open_repo("/mock/repo/path"), self.repo_instance)
+        self.mock_repo.assert_called_once_with("/mock/repo/path", search_parent_directories=True,
+                                               odbt=git.GitCmdObjectDB)
     
-    def test_get_git_diff_invalid_repo(self):
+    def test_open_repo_invalid_repo(self):
         """Test handling invalid git repository"""
         # Mock the Repo constructor to raise InvalidGitRepositoryError
         self.mock_repo.side_effect = git.exc.InvalidGitRepositoryError
         
-        # Redirect stdout to capture print statements
-        captured_output = io.StringIO()
-        sys.stdout = captured_output
+        with self.assertLogs("gitdiff", level="ERROR") as logs:
+            self.assertIsNone(ggd.open_repo("/not/a/repo"))
         
-        ggd.get_git_diff("/not/a/repo", self.temp_output, [])
+        # Check error message
+        self.assertIn("Error: Not a valid git repository", logs.output[0])
+    
+    def test_open_repo_bare(self):
+        """Test refusing a bare repository"""
+        self.repo_instance.bare = True
         
-        # Reset stdout
-        sys.stdout = sys.__stdout__
+        with self.assertLogs("gitdiff", level="ERROR") as logs:
+            self.assertIsNone(ggd.open_repo("/mock/repo/path"))
         
-        # Check error message
-        self.assertIn("Error: Not a valid git repository", captured_output.getvalue())
+        self.assertIn("Error: Repository is bare", logs.output[0])
         
-    @patch('get_git_diff.write_to_file')
-    def test_get_branch_diff_success(self, mock_write):
+    def test_get_branch_diff_success(self):
         """Test successful branch comparison"""
         # Configure repo mock
-        self.repo_instance.heads = ['main', 'feature']
-        self.repo_instance.refs = ['origin/main', 'origin/feature']
-        self.repo_instance.git.diff.return_value = "Sample branch diff"
+        self.repo_instance.heads = named_refs('main', 'feature')
+        self.repo_instance.refs = named_refs('origin/main', 'origin/feature')
+        self.git_diff_output(b"Sample branch diff\n")
+        
+        with self.assertLogs("gitdiff", level="INFO") as logs:
+            ggd.get_branch_diff(self.repo_instance, "feature", "main", self.temp_output, [])
+        
+        # Check diff was called with correct branches
+        self.assertEqual(self.git_diff_args(), [["main", "feature", "--"]])
+        
+        # Verify the output file has the correct content
+        output = self.read_output()
+        self.assertIn(b"feature", output)
+        self.assertIn(b"main", output)
+        self.assertIn(b"Sample branch diff", output)
+        self.assertNotIn(b"No differences found", output)
+        self.assertIn("INFO:gitdiff:Branch diff: 1 lines", logs.output)
+    
+    def test_get_branch_diff_max_lines(self):
+        """Test that --max-lines also applies to branch comparison"""
+        self.repo_instance.heads = named_refs('main', 'feature')
+        self.git_diff_output(b"line 1\nline 2\nline 3\n")
+        
+        ggd.get_branch_diff(self.repo_instance, "feature", "main", self.temp_output, [], quiet=True, max_lines=1)
+        
+        output = self.read_output()
+        self.assertTrue(output.endswith(b"line 1\n...<truncated 2 more lines>\n"))
+    
+    def test_get_branch_diff_print_diff(self):
+        """Test that --print-diff echoes the branch diff bytes unchanged"""
+        self.repo_instance.heads = named_refs('main', 'feature')
+        self.git_diff_output("caf\u00e9\n".encode("utf-8"))
         
         # Redirect stdout to capture print statements
-        captured_output = io.StringIO()
+        captured_output = io.TextIOWrapper(io.BytesIO())
         sys.stdout = captured_output
         
-        ggd.get_branch_diff("/mock/repo/path", "feature", "main", self.temp_output, [])
+        with self.assertLogs("gitdiff", level="INFO") as logs:
+            ggd.get_branch_diff(self.repo_instance, "feature", "main", self.temp_output, [], print_diff=True)
         
         # Reset stdout
+        captured_output.flush()
         sys.stdout = sys.__stdout__
         
-        # Check diff was called with correct branches
-        self.repo_instance.git.diff.assert_called_once_with("main", "feature", "--")
+        # The echo ends with a newline and the summary is logged, the same as for local changes
+        self.assertTrue(captured_output.buffer.getvalue().endswith("caf\u00e9\n\n".encode("utf-8")))
+        self.assertIn("INFO:gitdiff:Branch diff: 1 lines", logs.output)
+    
+    def test_get_branch_diff_summary(self):
+        """Test branch comparison that only asks git for a summary"""
+        self.repo_instance.heads = named_refs('main', 'feature')
         
-        # Verify write_to_file was called with correct content
-        mock_write.assert_called_once()
-        self.assertIn("feature", mock_write.call_args[0][1])
-        self.assertIn("main", mock_write.call_args[0][1])
-        self.assertIn("Sample branch diff", mock_write.call_args[0][1])
+        ggd.get_branch_diff(self.repo_instance, "feature", "main", self.temp_output, (":(exclude)node_modules",),
+                            summary="name-status")
+        
+        self.assertEqual(self.git_diff_args(), [["main", "feature", "--name-status", "--", ":(exclude)node_modules"]])
     
-    @patch('get_git_diff.write_to_file')
-    def test_get_branch_diff_use_current_branch(self, mock_write):
+    def test_get_branch_diff_pygit2(self):
+        """Test that branch comparison uses pygit2 when it is available"""
+        self.repo_instance.heads = named_refs('main', 'feature')
+        self.mock_pygit2.return_value = iter([b"Sample pygit2 diff\n", b"Second file\n"])
+        
+        ggd.get_branch_diff(self.repo_instance, "feature", "main", self.temp_output, (":(exclude)node_modules",))
+        
+        # No git process was started
+        self.mock_pygit2.assert_called_once_with("/mock/repo/path", "main", "feature", (":(exclude)node_modules",))
+        self.mock_popen.assert_not_called()
+        self.assertIn(b"Sample pygit2 diff\nSecond file\n", self.read_output())
+    
+    def test_get_branch_diff_use_current_branch(self):
         """Test branch comparison with current branch as feature branch"""
         # Configure repo mock for active branch
         active_branch = MagicMock()
         active_branch.name = "current-branch"
         self.repo_instance.active_branch = active_branch
-        self.repo_instance.heads = ['main', 'current-branch']
+        self.repo_instance.heads = named_refs('main', 'current-branch')
         
-        ggd.get_branch_diff("/mock/repo/path", None, "main", self.temp_output, [])
+        ggd.get_branch_diff(self.repo_instance, None, "main", self.temp_output, [])
         
         # Check we used the current branch
-        self.repo_instance.git.diff.assert_called_once_with("main", "current-branch", "--")
+        self.assertEqual(self.git_diff_args(), [["main", "current-branch", "--"]])
     
-    @patch('get_git_diff.write_to_file')
-    def test_get_branch_diff_remote_branch(self, mock_write):
+    def test_get_branch_diff_remote_branch(self):
         """Test branch comparison with remote branch"""
         # Configure repo mock with only remote branch
-        self.repo_instance.heads = ['feature']  # main not in local heads
-        self.repo_instance.refs = ['origin/main', 'origin/feature']
+        self.repo_instance.heads = named_refs('feature')  # main not in local heads
+        self.repo_instance.refs = named_refs('origin/main', 'origin/feature')
         
-        ggd.get_branch_diff("/mock/repo/path", "feature", "main", self.temp_output, [])
+        with self.assertLogs("gitdiff", level="INFO") as logs:
+            ggd.get_branch_diff(self.repo_instance, "feature", "main", self.temp_output, [])
         
-        # Check we used the remote branch
-        self.repo_instance.git.diff.assert_called_once_with("origin/main", "feature", "--")
+        # Check we used the remote branch, which is not a problem worth showing under --quiet
+        self.assertEqual(self.git_diff_args(), [["origin/main", "feature", "--"]])
+        self.assertTrue(all(record.levelname == "INFO" for record in logs.records))
+    
+    def test_get_branch_diff_cached_refs(self):
+        """Test that branch names are reused from the cache while the refs are unchanged"""
+        self.repo_instance.heads = named_refs('main', 'feature')
+        ggd.get_branch_diff(self.repo_instance, "feature", "main", self.temp_output, [], quiet=True)
+        
+        # A second run finds both branches without scanning the refs again
+        self.repo_instance.heads = named_refs()
+        ggd.get_branch_diff(self.repo_instance, "feature", "main", self.temp_output, [], quiet=True)
+        self.assertEqual(self.git_diff_args(), [["main", "feature", "--"], ["main", "feature", "--"]])
+    
+    def test_get_branch_diff_refreshes_cached_refs(self):
+        """Test that a branch missing from the cache is looked up in the repository"""
+        self.repo_instance.heads = named_refs('main', 'feature')
+        ggd.get_branch_diff(self.repo_instance, "feature", "main", self.temp_output, [], quiet=True)
+        
+        self.repo_instance.heads = named_refs('main', 'feature', 'new-feature')
+        ggd.get_branch_diff(self.repo_instance, "new-feature", "main", self.temp_output, [], quiet=True)
+        self.assertEqual(self.git_diff_args()[-1], ["main", "new-feature", "--"])
     
     @patch('get_git_diff.write_to_file')
     def test_get_branch_diff_nonexistent_branches(self, mock_write):
         """Test branch comparison with nonexistent branches"""
         # Configure repo mock with no matching branches
-        self.repo_instance.heads = ['dev']
-        self.repo_instance.refs = ['origin/dev']
+        self.repo_instance.heads = named_refs('dev')
+        self.repo_instance.refs = named_refs('origin/dev')
         
-        # Redirect stdout to capture print statements
-        captured_output = io.StringIO()
-        sys.stdout = captured_output
+        with self.assertLogs("gitdiff", level="WARNING") as logs:
+            ggd.get_branch_diff(self.repo_instance, "feature", "main", self.temp_output, [])
         
-        ggd.get_branch_diff("/mock/repo/path", "feature", "main", self.temp_output, [])
+        # Check error messages
+        self.assertIn("ERROR:gitdiff:Error: Target branch 'main' does not exist locally or remotely.",
+                      logs.output)
         
-        # Reset stdout
-        sys.stdout = sys.__stdout__
+    def test_get_branch_diff_no_differences(self):
+        """Test branch comparison of identical branches"""
+        self.repo_instance.heads = named_refs('main', 'feature')
         
-        # Check error messages
-        self.assertIn("does not exist locally or remotely", captured_output.getvalue())
+        ggd.get_branch_diff(self.repo_instance, "feature", "main", self.temp_output, [], quiet=True)
         
+        self.assertIn(b"No differences found between the branches.", self.read_output())
+    
     def test_write_to_file(self):
         """Test writing content to file"""
-        test_content = "Test content for file writing"
+        test_content = b"Test content for file writing"
         
-        # Redirect stdout to capture print statements
-        captured_output = io.StringIO()
-        sys.stdout = captured_output
-        
-        ggd.write_to_file(self.temp_output, test_content)
-        
-        # Reset stdout
-        sys.stdout = sys.__stdout__
+        with self.assertLogs("gitdiff", level="INFO") as logs:
+            ggd.write_to_file(self.temp_output, test_content)
         
         # Verify the file was created with correct content
-        with open(self.temp_output, 'r') as f:
+        with open(self.temp_output, 'rb') as f:
             content = f.read()
             self.assertEqual(content, test_content)
             
-        # Check print output
-        self.assertIn(f"Diff result saved to file: {self.temp_output}", captured_output.getvalue())
+        # Check log output
+        self.assertEqual(logs.output, [f"INFO:gitdiff:Diff result saved to file: {self.temp_output}"])
     
     @patch('argparse.ArgumentParser.parse_args')
     def test_prepare_args(self, mock_parse_args):
@@ -210,7 +469,146 @@ class TestGitDiffUtility(unittest.TestCase):
         self.assertEqual(args.feature_branch, "feature")
         self.assertEqual(args.target_branch, "main")
         self.assertEqual(args.output, "output.diff")
-        self.assertEqual(args.exclude, ["node_modules", "*.log"])
+        self.assertEqual(args.exclude, (ggd.DEFAULT_EXCLUDE, "node_modules", "*.log"))
+
+    def test_prepare_args_max_lines(self):
+        """Test that --max-lines takes a count and rejects negative ones"""
+        with patch.object(sys, 'argv', ["get_git_diff.py", "--max-lines", "5"]):
+            self.assertEqual(ggd.prepare_args().max_lines, 5)
+        for value in ("-1", "five"):
+            with self.subTest(value=value), patch.object(sys, 'argv', ["get_git_diff.py", "--max-lines", value]), \
+                    patch('sys.stderr', io.StringIO()) as stderr, self.assertRaises(SystemExit):
+                ggd.prepare_args()
+            self.assertIn("--max-lines", stderr.getvalue())
+
+    def test_is_excluded(self):
+        """Test matching paths against exclude pathspecs"""
+        exclude_args = ggd.build_exclude_args(["src/Migrations/", "docs", "*.log"])
+        self.assertTrue(ggd.is_excluded("src/Migrations/001_init.cs", exclude_args))
+        self.assertTrue(ggd.is_excluded("docs", exclude_args))
+        self.assertTrue(ggd.is_excluded("docs/readme.md", exclude_args))
+        self.assertTrue(ggd.is_excluded("build/out/app.log", exclude_args))
+        self.assertFalse(ggd.is_excluded("src/Program.cs", exclude_args))
+        self.assertFalse(ggd.is_excluded("docsite/index.md", exclude_args))
+        self.assertTrue(ggd.is_excluded("docs/readme.md", ggd.build_exclude_args(["./docs/../docs/"])))
+        self.assertTrue(ggd.is_excluded("readme.md", ggd.build_exclude_args(["."])))
+
+    def test_exclude_pattern(self):
+        """Test normalising exclude pathspecs, and refusing those git matches differently"""
+        self.assertEqual(ggd.exclude_pattern(":(exclude)./docs"), "docs")
+        self.assertEqual(ggd.exclude_pattern(":(exclude)src//a/./b/"), "src/a/b/")
+        for pattern in ("../docs", "/docs", ":(glob)docs", ""):
+            with self.subTest(pattern=pattern):
+                self.assertIsNone(ggd.exclude_pattern(ggd.EXCLUDE_MAGIC + pattern))
+    
+    def test_build_exclude_args(self):
+        """Test turning exclude patterns into pathspecs"""
+        self.assertEqual(ggd.build_exclude_args(["node_modules", "*.log", "node_modules"]),
+                         (":(exclude)node_modules", ":(exclude)*.log"))
+
+@unittest.skipUnless(pygit2, "pygit2 is not installed")
+class TestPygit2Diff(unittest.TestCase):
+    """Run the pygit2 backend against `git diff` on a real repository"""
+
+    def git(self, *args):
+        return subprocess.run(["git", "-c", "user.name=Test", "-c", "user.email=test@example.com",
+                               "-c", "commit.gpgsign=false", *args],
+                              cwd=self.repo_path, stdout=subprocess.PIPE, check=True).stdout
+
+    def write(self, name, content):
+        path = os.path.join(self.repo_path, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+    def commit_branch(self, branch, *moves, files=()):
+        self.git("checkout", "-q", "-b", branch, "main")
+        for source, destination in moves:
+            self.git("mv", source, destination)
+        for name, content in files:
+            self.write(name, content)
+        self.git("add", "-A")
+        self.git("commit", "-q", "-m", branch)
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.repo_path = os.path.join(self.temp_dir.name, "repo")
+        self.excluded = ggd.DEFAULT_EXCLUDE
+        self.exclude_args = ggd.build_exclude_args([self.excluded])
+        os.makedirs(self.repo_path)
+        self.git("init", "-q", "-b", "main")
+        contents = "".join(f"line {i}\n" for i in range(20))
+        for name in ("f.txt", "g.txt", "docs/d.md", self.excluded + "001_init.cs"):
+            self.write(name, f"{name}\n{contents}")
+        self.git("add", "-A")
+        self.git("commit", "-q", "-m", "initial")
+        self.commit_branch("into-excluded", ("f.txt", self.excluded + "f.txt"))
+        self.commit_branch("out-of-excluded", (self.excluded + "001_init.cs", "init.cs"))
+        self.commit_branch("plain-rename", ("f.txt", "h.txt"))
+        self.commit_branch("docs", files=[("docs/d.md", "changed docs\n"), ("g.txt", f"g.txt\n{contents}more\n")])
+        self.commit_branch("empty-file", files=[("empty.txt", "")])
+
+        patcher = patch('get_git_diff.CACHE_DIR', os.path.join(self.temp_dir.name, "cache"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def git_diff(self, feature_branch, exclude_args=None):
+        exclude_args = self.exclude_args if exclude_args is None else exclude_args
+        return self.git("diff", "--no-color", "main", feature_branch, "--", *exclude_args)
+
+    def test_matches_git_diff(self):
+        """Test that branch diffs match git across renames into and out of excluded paths"""
+        repo = ggd.open_repo(self.repo_path)
+        output = os.path.join(self.temp_dir.name, "out.diff")
+        dot_exclude_args = ggd.build_exclude_args([self.excluded, "./docs"])
+        cases = [("into-excluded", self.exclude_args, {}), ("out-of-excluded", self.exclude_args, {}),
+                 ("plain-rename", self.exclude_args, {}), ("docs", dot_exclude_args, {}),
+                 ("empty-file", self.exclude_args, {}), ("docs", self.exclude_args, {"diff.context": "1"}),
+                 ("docs", self.exclude_args, {"diff.algorithm": "histogram"})]
+        for feature_branch, exclude_args, config in cases:
+            with self.subTest(feature_branch, config=config):
+                for name, value in config.items():
+                    self.git("config", name, value)
+                try:
+                    ggd.get_branch_diff(repo, feature_branch, "main", output, exclude_args, quiet=True)
+                    expected = self.git_diff(feature_branch, exclude_args)
+                finally:
+                    for name in config:
+                        self.git("config", "--unset", name)
+                with open(output, "rb") as f:
+                    f.readline()
+                    self.assertEqual(f.read(), expected)
+
+    def test_applies_diff_config(self):
+        """Test that pygit2 follows the diff settings it can and leaves the others to git"""
+        self.git("config", "diff.context", "1")
+        patches = ggd.pygit2_diff(self.repo_path, "main", "docs", self.exclude_args)
+        self.assertEqual(b"".join(patches), self.git_diff("docs"))
+        for name, value in (("diff.algorithm", "histogram"), ("diff.noprefix", "true")):
+            with self.subTest(name):
+                self.git("config", name, value)
+                self.assertIsNone(ggd.pygit2_diff(self.repo_path, "main", "docs", self.exclude_args))
+                self.git("config", "--unset", name)
+
+    def test_falls_back_on_errors(self):
+        """Test that a diff libgit2 cannot produce is left to git"""
+        self.assertIsNone(ggd.pygit2_diff(self.repo_path, "main", "missing", self.exclude_args))
+
+    def test_normalises_exclude_patterns(self):
+        """Test that pygit2 excludes paths given with a ./ prefix like git does"""
+        exclude_args = ggd.build_exclude_args(["./docs"])
+        patches = ggd.pygit2_diff(self.repo_path, "main", "docs", exclude_args)
+        self.assertEqual(b"".join(patches), self.git_diff("docs", exclude_args))
+        self.assertNotIn(b"docs/d.md", self.git_diff("docs", exclude_args))
+
+    def test_falls_back_on_renames_across_exclusion(self):
+        """Test that pygit2 leaves renames across the exclusion boundary to git"""
+        for feature_branch in ("into-excluded", "out-of-excluded"):
+            with self.subTest(feature_branch):
+                self.assertIsNone(ggd.pygit2_diff(self.repo_path, "main", feature_branch, self.exclude_args))
+        patches = ggd.pygit2_diff(self.repo_path, "main", "plain-rename", self.exclude_args)
+        self.assertEqual(b"".join(patches), self.git_diff("plain-rename"))
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file